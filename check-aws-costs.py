@@ -6,12 +6,24 @@
 # SPDX-License-Identifier: (MIT)
 
 import argparse
+import hashlib
 import json
 import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
+from functools import partial
 
 import boto3
 import pandas
+import pyarrow
+import pyarrow.csv
+
+# orjson is much faster, but optional
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # https://docs.aws.amazon.com/aws-cost-management/latest/APIReference/API_GetCostAndUsage.html
 # We set a dimension, metrics, and granularity, but not a filter
@@ -42,12 +54,17 @@ metrics_choices = [
     "UsageQuantity",
 ]
 
+format_choices = ["csv", "parquet"]
+
 
 # Get a full year of a range between today and tomorrow
 today = datetime.now()
 tomorrow = today + timedelta(days=1)
 here = os.path.dirname(os.path.abspath(__file__))
 
+# Days after which cached daily cost data is not expected to change
+cache_settle_days = 2
+
 
 def get_parser():
     parser = argparse.ArgumentParser(
@@ -62,6 +79,27 @@ def get_parser():
         help="directory for data cache (defaults to $PWD/cache).",
         default=os.path.join(here, "cache"),
     )
+    parser.add_argument(
+        "--no-cache",
+        dest="no_cache",
+        help="Do not use (or write) cached daily responses under <data-dir>/ce_cache.",
+        default=False,
+        action="store_true",
+    )
+    parser.add_argument(
+        "--min-total",
+        dest="min_total",
+        help="Only ask for groups with at least this total over the range (e.g., 5)",
+        default=None,
+        type=float,
+    )
+    parser.add_argument(
+        "-f",
+        "--format",
+        help="One or more formats for the formatted results (defaults to csv)",
+        action="append",
+        choices=format_choices,
+    )
     parser.add_argument(
         "-r",
         "--region",
@@ -106,55 +144,235 @@ def write_json(obj, path):
     """
     Write json to file
     """
+    if orjson is not None:
+        with open(path, "wb") as fd:
+            fd.write(orjson.dumps(obj, option=orjson.OPT_INDENT_2))
+        return
     with open(path, "w") as fd:
-        fd.write(json.dumps(obj, indent=4))
+        json.dump(obj, fd, indent=4)
+
+
+def read_json(path):
+    """
+    Read json from file
+    """
+    if orjson is not None:
+        with open(path, "rb") as fd:
+            return orjson.loads(fd.read())
+    with open(path, "r") as fd:
+        return json.load(fd)
+
+
+def query_region(
+    client, region, dimension, metrics, granularity, start, groups=None, exclude=None
+):
+    """
+    Query cost and usage for one region (or "all" for no region filter).
+
+    The region "other" is everything not in exclude, including charges that
+    have no region (e.g., tax). If groups are provided, only those values of
+    the dimension are asked for.
+    """
+    filters = []
+    if region == "other":
+        filters.append({"Not": {"Dimensions": {"Key": "REGION", "Values": exclude}}})
+    elif region != "all":
+        filters.append({"Dimensions": {"Key": "REGION", "Values": [region]}})
+    if groups:
+        filters.append({"Dimensions": {"Key": dimension, "Values": groups}})
+
+    extra = {}
+    if len(filters) == 1:
+        extra = {"Filter": filters[0]}
+    elif filters:
+        extra = {"Filter": {"And": filters}}
+
+    print(f"Querying for daily cost by service for {region}")
+    kwargs = dict(
+        GroupBy=[{"Key": dimension, "Type": "DIMENSION"}],
+        TimePeriod={
+            "Start": start.strftime("%Y-%m-%d"),
+            "End": tomorrow.strftime("%Y-%m-%d"),
+        },
+        Granularity=granularity,
+        Metrics=metrics,
+        **extra,
+    )
+
+    # Results can be paginated, keep asking until there is no next token
+    results = []
+    while True:
+        response = client.get_cost_and_usage(**kwargs)
+        if "ResultsByTime" not in response:
+            raise ValueError("Key ResultsByTime missing from response.")
+        results += response["ResultsByTime"]
+        token = response.get("NextPageToken")
+        if not token:
+            break
+        kwargs["NextPageToken"] = token
+    return results
+
+
+def get_digest(values):
+    """
+    Get a short digest for a list of values (e.g., for a cache directory name)
+    """
+    return hashlib.sha256("\n".join(sorted(values)).encode()).hexdigest()[:12]
+
+
+def query_region_cached(
+    client,
+    region,
+    dimension,
+    metrics,
+    granularity,
+    start,
+    cache_dir,
+    groups=None,
+    exclude=None,
+):
+    """
+    Query cost and usage for one region, reusing days we have already cached.
+
+    Cost data for a day keeps changing for a little while, so a cached day is
+    only trusted if it was written at least cache_settle_days after it, and
+    Cost Explorer no longer marked it as Estimated (the bill is final). This
+    means the last cache_settle_days days (through today) are always fetched
+    again, so there is still one (small) query per region, and so are days of
+    a month whose bill is not final yet.
+    """
+    cache_dir = os.path.join(cache_dir, dimension.lower(), "-".join(sorted(metrics)))
+
+    # Results for a subset of groups are kept apart from the full set
+    if groups:
+        cache_dir = os.path.join(cache_dir, f"groups-{get_digest(groups)}")
+
+    # What is "other" depends on the regions that were asked for
+    if region == "other":
+        cache_dir = os.path.join(cache_dir, f"other-{get_digest(exclude)}")
+    else:
+        cache_dir = os.path.join(cache_dir, region)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    # Find the first day we don't have (or can't trust), we ask for the rest
+    midnight = datetime.combine(today.date(), datetime.min.time())
+    refetch = midnight - timedelta(days=cache_settle_days - 1)
+    cached = []
+    day = start
+    while day < refetch:
+        path = os.path.join(cache_dir, f"{day.strftime('%Y-%m-%d')}.json")
+        if not os.path.exists(path):
+            break
+        written = datetime.fromtimestamp(os.path.getmtime(path))
+        if written - day < timedelta(days=cache_settle_days):
+            break
+        periods = read_json(path)
+        if any(period.get("Estimated") for period in periods):
+            break
+        cached += periods
+        day += timedelta(days=1)
+
+    # Save new results by day (a day can come back across more than one page)
+    results = query_region(
+        client,
+        region,
+        dimension,
+        metrics,
+        granularity,
+        day,
+        groups=groups,
+        exclude=exclude,
+    )
+    by_day = {}
+    for period in results:
+        by_day.setdefault(period["TimePeriod"]["Start"], []).append(period)
+    for datestr, periods in by_day.items():
+        write_json(periods, os.path.join(cache_dir, f"{datestr}.json"))
+    return cached + results
+
+
+def get_group_totals(client, dimension, metrics, start):
+    """
+    Get the total (of the first metric) for each group, across all regions.
+
+    This uses monthly granularity, so it is a small response.
+    """
+    totals = {}
+    for period in query_region(client, "all", dimension, metrics, "MONTHLY", start):
+        for item in period["Groups"]:
+            group = "_".join(item["Keys"])
+            amount = float(item["Metrics"][metrics[0]]["Amount"])
+            totals[group] = totals.get(group, 0) + amount
+    return totals
 
 
 def get_cost_data(
-    regions, dimension="SERVICE", metrics=None, granularity="DAILY", start=90
+    regions,
+    dimension="SERVICE",
+    metrics=None,
+    granularity="DAILY",
+    start=90,
+    cache_dir=None,
+    min_total=None,
 ):
     """
     Get start days back of cost data for a list of regions.
+
+    Everything outside of those regions (including charges without a region)
+    is returned as region "other".
+
+    If a cache_dir is provided (and granularity is DAILY) days are cached there,
+    under the AWS account id of the caller.
+    If min_total is provided, groups with a smaller total are not asked for.
     """
     data = {}
     if not metrics:
         metrics = ["AmortizedCost"]
 
-    # Start this many days ago
+    # Start this many days ago (at midnight, to line up with daily periods)
     start = tomorrow - timedelta(days=start)
-
-    # Create cost explorer client, across regions we use
-    for region in regions:
-        extra = {}
-        if region != "all":
-            extra = {
-                "Filter": {
-                    "Dimensions": {
-                        "Key": "REGION",
-                        "Values": [region],
-                    }
-                }
-            }
-
-        print(f"Querying for daily cost by service for {region}")
-        data[region] = []
-        client = boto3.client("ce", region_name=region)
-        response = client.get_cost_and_usage(
-            GroupBy=[{"Key": dimension, "Type": "DIMENSION"}],
-            TimePeriod={
-                "Start": start.strftime("%Y-%m-%d"),
-                "End": tomorrow.strftime("%Y-%m-%d"),
-            },
-            Granularity=granularity,
-            Metrics=metrics,
-            **extra,
+    start = datetime.combine(start.date(), datetime.min.time())
+
+    # Cost explorer is a global endpoint (the region is a filter) so one client
+    # is enough, and client method calls are safe to share across threads
+    client = boto3.client("ce", region_name="us-east-1")
+
+    # Everything else goes into "other" so nothing is missing from the total
+    regions = list(regions) + ["other"]
+
+    # Filter out small groups on the server side instead of after the fact
+    groups = None
+    if min_total is not None:
+        totals = get_group_totals(client, dimension, metrics, start)
+        groups = sorted(g for g, total in totals.items() if total >= min_total)
+        print(f"Keeping {len(groups)} of {len(totals)} groups, total >= {min_total}")
+        if not groups:
+            return {region: [] for region in regions}
+
+    # Only daily data is cached, other granularities don't line up with days
+    exclude = regions[:-1]
+    query = partial(query_region, groups=groups, exclude=exclude)
+    if cache_dir and granularity == "DAILY":
+        # Cached data is per account, so another profile doesn't see it
+        account = boto3.client("sts").get_caller_identity()["Account"]
+        cache_dir = os.path.join(cache_dir, account)
+        query = partial(
+            query_region_cached, cache_dir=cache_dir, groups=groups, exclude=exclude
         )
-        if "ResultsByTime" not in response:
-            raise ValueError("Key ResultsByTime missing from response.")
 
-        # Save data to region
-        data[region] = response["ResultsByTime"]
-    return data
+    # Each region is an independent (network bound) request, so run them together
+    with ThreadPoolExecutor(max_workers=len(regions)) as executor:
+        futures = {
+            executor.submit(
+                query, client, region, dimension, metrics, granularity, start
+            ): region
+            for region in regions
+        }
+        for future in as_completed(futures):
+            data[futures[future]] = future.result()
+
+    # Keep regions in the order they were asked for
+    return {region: data[region] for region in regions}
 
 
 def organize_data(data):
@@ -162,9 +380,9 @@ def organize_data(data):
     Organize data into pandas dataframe for easier plotting later
     """
     columns = ["region", "group", "metric", "amount", "unit", "start_date", "end_date"]
-    df = pandas.DataFrame(columns=columns)
 
-    idx = 0
+    # Collect rows first and build the data frame once at the end
+    rows = []
     for region, listing in data.items():
         print(f"Adding {region} to the data frame...")
         # keys: ['TimePeriod', 'Total', 'Groups', 'Estimated']
@@ -176,41 +394,66 @@ def organize_data(data):
             for item in period["Groups"]:
                 # Each item has Keys (for service, etc) and metrics
                 # This is typically one thing.
-                group = "_".join(item["Keys"]).replace(" ", "-").lower()
+                group = "_".join(item["Keys"])
                 for metric, values in item["Metrics"].items():
                     unit = values["Unit"]
 
                     # Geezers this is a string...
                     amount = float(values["Amount"])
-                    df.loc[idx, :] = [
-                        region,
-                        group,
-                        metric,
-                        amount,
-                        unit,
-                        start,
-                        ending,
-                    ]
-                    idx += 1
+                    rows.append((region, group, metric, amount, unit, start, ending))
+    df = pandas.DataFrame.from_records(rows, columns=columns)
+
+    # Clean up group names all at once (arrow strings are much faster here)
+    group = df["group"].astype("string[pyarrow]")
+    df["group"] = group.str.replace(" ", "-", regex=False).str.lower()
     return df
 
 
+def add_total(df):
+    """
+    Add the sum across regions (including "other") as region "all"
+    """
+    columns = ["group", "metric", "unit", "start_date", "end_date"]
+    total = df.groupby(columns, as_index=False)["amount"].sum()
+    total["region"] = "all"
+    return pandas.concat([df, total[df.columns]], ignore_index=True)
+
+
 def save(data, data_dir, result_type="", fmt="json"):
     """
     Announce relative path for results to be saved
 
     This save function is over-engineered. It's ok.
     """
-    # This saves with two suffix
-    for suffix in [today.strftime("%Y-%m-%d"), "latest"]:
-        outfile = os.path.join(data_dir, f"spending-{suffix}.{fmt}")
-        relpath = os.path.relpath(outfile)
-        print(f"Saving {result_type} results to {relpath}")
-
-        if fmt == "json":
-            write_json(data, outfile)
-        else:
-            data.to_csv(outfile)
+    # This saves with two suffix, the second (latest) is a link to the first
+    outfile = os.path.join(data_dir, f"spending-{today.strftime('%Y-%m-%d')}.{fmt}")
+    print(f"Saving {result_type} results to {os.path.relpath(outfile)}")
+    if fmt == "json":
+        write_json(data, outfile)
+    elif fmt == "parquet":
+        # Keep types, so the plot script doesn't need to convert them again
+        labels = ["region", "group", "metric", "unit"]
+        data = data.astype({label: "category" for label in labels})
+        for column in ["start_date", "end_date"]:
+            data[column] = pandas.to_datetime(data[column], format="%Y-%m-%d")
+        data.to_parquet(outfile, engine="pyarrow", compression="snappy")
+    else:
+        # The index is kept as the first column (the plot script reads it as such)
+        table = pyarrow.Table.from_pandas(data.reset_index(), preserve_index=False)
+        pyarrow.csv.write_csv(table, outfile)
+
+    latest = os.path.join(data_dir, f"spending-latest.{fmt}")
+    print(f"Saving {result_type} results to {os.path.relpath(latest)}")
+    try:
+        os.unlink(latest)
+    except FileNotFoundError:
+        pass
+
+    # Not all filesystems support hard links
+    try:
+        os.link(outfile, latest)
+    except OSError:
+        shutil.copyfile(outfile, latest)
 
 
 def run():
@@ -226,25 +469,27 @@ def run():
     if not os.path.exists(args.data_dir):
         os.makedirs(args.data_dir)
 
-    # Also generate total
-    if "all" not in args.region:
-        args.region.append("all")
+    # The total ("all") is computed from the regions we have (and "other")
+    regions = [x for x in args.region if x not in ["all", "other"]]
 
     # Create organized data by region
     data = get_cost_data(
-        args.region,
+        regions,
         dimension=args.dimension,
         metrics=args.metric,
         granularity=args.granularity,
         start=args.start,
+        cache_dir=None if args.no_cache else os.path.join(args.data_dir, "ce_cache"),
+        min_total=args.min_total,
     )
 
     # Save to data directory
     save(data, args.data_dir, "raw", "json")
 
     # These are organized into a table
-    df = organize_data(data)
-    save(df, args.data_dir, "formatted", "csv")
+    df = add_total(organize_data(data))
+    for fmt in args.format or ["csv"]:
+        save(df, args.data_dir, "formatted", fmt)
 
 
 if __name__ == "__main__":
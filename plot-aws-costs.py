@@ -10,12 +10,14 @@ import os
 import random
 from datetime import datetime
 
+import matplotlib.dates as mdates
 import matplotlib.pyplot as plt
 import pandas
 import seaborn as sns
 from matplotlib import colormaps as cm
+from matplotlib.backends.backend_pdf import PdfPages
 
-# set seaborn style
+# set seaborn style (plots are drawn with matplotlib directly)
 sns.set_theme()
 
 # Get a full year of a range between today and tomorrow
@@ -32,7 +34,7 @@ def get_parser():
     # Save a local cache right here
     parser.add_argument(
         "--csv",
-        help="csv data frame file to plot (defaults to $PWD/cache/spending-latest.csv).",
+        help="csv or parquet data frame file to plot (defaults to $PWD/cache/spending-latest.csv).",
         default=os.path.join(here, "cache", "spending-latest.csv"),
     )
     parser.add_argument(
@@ -62,42 +64,64 @@ def run():
 
     # Create output directory
     if not os.path.exists(args.csv):
-        raise ValueError(f"CSV file {args.csv} does not exist.")
-
-    # Read in data, index column is 0
-    df = pandas.read_csv(args.csv, index_col=0)
+        raise ValueError(f"Data file {args.csv} does not exist.")
+
+    # Read in data, index column is 0. The labels repeat a lot, so they are categories
+    # Parquet already has the categories and datetimes (the axis formats them)
+    if args.csv.endswith(".parquet"):
+        df = pandas.read_parquet(args.csv, engine="pyarrow")
+        df["start"] = df["start_date"]
+    else:
+        df = pandas.read_csv(
+            args.csv,
+            index_col=0,
+            engine="pyarrow",
+            dtype={
+                "region": "category",
+                "group": "category",
+                "metric": "category",
+                "unit": "category",
+                "amount": "float64",
+                "start_date": "string",
+                "end_date": "string",
+            },
+        )
+
+        # Convert dates to datetime.date
+        # I'm not sure if these are actually different, they look the same lol
+        # df['start'] = df['start_date'].map(lambda x:to_date(x))
+        # df['end'] = df['end_date'].map(lambda x:to_date(x))
+        # These stay as datetimes, the axis takes care of formatting
+        df["start"] = pandas.to_datetime(
+            df["start_date"], format="%Y-%m-%d", cache=True
+        )
 
     # Determine which groups to skip (if sum for region is < $5)
     # Note that it looks like some of these are actual NEGATIVE which is weird
-    keepers = set()
-    for group in df.group.unique():
-        subset = df[df.group == group]
-
-        # Is the total under $5?
-        if subset.amount.sum() < 5:
-            print(f"Skipping {group} - total across regions is < $5")
-            continue
-        keepers.add(group)
-
-    # Total plots are the number of groups by metrics (each plot has all regions)
-    total_plots = 2 * len(keepers) * len(df.metric.unique())
+    totals = df.groupby("group", observed=True)["amount"].sum()
+    for group in totals[totals < 5].index:
+        print(f"Skipping {group} - total across regions is < $5")
+    keepers = set(totals.index[totals >= 5])
 
     # Make some nice colors
     colors = [list(x) for x in cm["Paired"].colors]
     random.shuffle(colors)
     region_colors = {}
-    for i, region in enumerate(df.region.unique()):
+    for i, region in enumerate(df["region"].cat.categories):
         region_colors[region] = colors[i]
 
-    # Convert dates to datetime.date
-    # I'm not sure if these are actually different, they look the same lol
-    # df['start'] = df['start_date'].map(lambda x:to_date(x))
-    # df['end'] = df['end_date'].map(lambda x:to_date(x))
-    df["start"] = pandas.to_datetime(df["start_date"]).dt.strftime("%Y-%m-%d")
-    df["end"] = pandas.to_datetime(df["end_date"]).dt.strftime("%Y-%m-%d")
+    # Each metric gets its own line style (the color is for the region)
+    styles = ["-", "--", ":", "-."]
+    metric_styles = {}
+    for i, metric in enumerate(df["metric"].cat.categories):
+        metric_styles[metric] = styles[i % len(styles)]
+
+    # One value per day, region and metric (metrics are never added together)
+    keys = ["group", "region", "metric", "unit", "start"]
+    df = df.groupby(keys, sort=False, observed=True, as_index=False)["amount"].sum()
 
-    # Stack dem pancakes
-    fig, axs = plt.subplots(nrows=total_plots, figsize=(12, total_plots * 3))
+    # Lines are drawn in order, so sort by time once
+    df = df.sort_values("start", kind="stable")
 
     # Date specific output directory (when generated)
     outdir = os.path.join(args.outdir, today.strftime("%Y-%m-%d"))
@@ -105,41 +129,76 @@ def run():
         os.makedirs(outdir)
 
     # We assume these are the same
-    if len(df.unit.unique()) > 1:
+    units = df["unit"].cat.categories
+    if len(units) > 1:
         raise ValueError("Trying to compare different units.")
-    unit = df.unit.unique()[0]
-
-    # Plot by group, line plots (by region and for all)
-    idx = 0
-    for group in df.group.unique():
-        if group not in keepers:
-            continue
-        subset = df[df.group == group]
-        by_region = subset[subset.region != "all"]
-        all_regions = subset[subset.region == "all"]
-        groups = {"for all regions": all_regions, "by region": by_region}
-        for k, v in groups.items():
-            ax = axs[idx]
-            ax.tick_params("x", labelrotation=90)
-            plot = sns.lineplot(
-                x="start",
-                y="amount",
-                markers=True,
-                data=v,
-                palette=region_colors,
-                hue="region",
-                ax=ax,
-            )
-            plot.set_title(f"AWS cost group {group} {k}")
-            plot.set_ylabel(f"Amount ({unit})")
-            idx += 1
-
-    fig.tight_layout()
-    fig.savefig(os.path.join(outdir, "aws-spending-by-region.pdf"))
-    plt.close()
-
-    # TODO Generate stacked area, one per group
-    # TODO: an accumulative view
+    unit = units[0]
+
+    # Plot by group, line plots (by region and for all), one page per group
+    # Stacked area plots (daily and accumulated) by region go to a second pdf
+    by_region_pdf = os.path.join(outdir, "aws-spending-by-region.pdf")
+    stacked_pdf = os.path.join(outdir, "aws-spending-stacked.pdf")
+    with PdfPages(by_region_pdf) as pdf, PdfPages(stacked_pdf) as stacked:
+        for group, subset in df.groupby("group", sort=False, observed=True):
+            if group not in keepers:
+                continue
+            is_all = subset["region"].values == "all"
+            by_region = subset[~is_all]
+            all_regions = subset[is_all]
+            groups = {"for all regions": all_regions, "by region": by_region}
+            fig, axs = plt.subplots(nrows=len(groups), figsize=(12, 3 * len(groups)))
+            for ax, (k, v) in zip(axs, groups.items()):
+                ax.tick_params("x", labelrotation=90)
+                lines = v.groupby(["region", "metric"], sort=False, observed=True)
+                for (region, metric), points in lines:
+                    ax.plot(
+                        points["start"].values,
+                        points["amount"].values,
+                        color=region_colors[region],
+                        linestyle=metric_styles[metric],
+                        label=f"{region} {metric}",
+                    )
+                ax.legend()
+                ax.xaxis.set_major_formatter(mdates.DateFormatter("%Y-%m-%d"))
+                ax.set_title(f"AWS cost group {group} {k}")
+                ax.set_ylabel(f"Amount ({unit})")
+
+            fig.tight_layout()
+            pdf.savefig(fig)
+            plt.close(fig)
+
+            # One (time by region) array, and its running total, for the stacked view
+            # Metrics are different views of the same cost, so each gets its own page
+            for metric, points in by_region.groupby("metric", observed=True):
+                pivot = points.pivot_table(
+                    index="start",
+                    columns="region",
+                    values="amount",
+                    aggfunc="sum",
+                    fill_value=0,
+                    observed=True,
+                ).sort_index()
+                views = {
+                    "stacked by region": pivot,
+                    "accumulated by region": pivot.cumsum(),
+                }
+                fig, axs = plt.subplots(nrows=len(views), figsize=(12, 3 * len(views)))
+                for ax, (k, v) in zip(axs, views.items()):
+                    ax.tick_params("x", labelrotation=90)
+                    ax.stackplot(
+                        v.index.values,
+                        v.values.T,
+                        labels=list(v.columns),
+                        colors=[region_colors[region] for region in v.columns],
+                    )
+                    ax.legend(loc="upper left")
+                    ax.xaxis.set_major_formatter(mdates.DateFormatter("%Y-%m-%d"))
+                    ax.set_title(f"AWS cost group {group} {metric} {k}")
+                    ax.set_ylabel(f"Amount ({unit})")
+
+                fig.tight_layout()
+                stacked.savefig(fig)
+                plt.close(fig)
 
 
 if __name__ == "__main__":